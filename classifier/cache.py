@@ -0,0 +1,71 @@
+import time
+from collections import OrderedDict
+from threading import Lock
+
+from PIL import Image
+
+
+def dhash(image: Image.Image, size: int = 8) -> int:
+    """64-bit difference hash of an image, robust to small noise and exposure."""
+    small = image.resize((size + 1, size), Image.BILINEAR, reducing_gap=2.0)
+    pixels = list(small.convert("L").getdata())
+    bits = 0
+    for row in range(size):
+        for col in range(size):
+            left = pixels[row * (size + 1) + col]
+            right = pixels[row * (size + 1) + col + 1]
+            bits = (bits << 1) | (left > right)
+    return bits
+
+
+class PredictionCache:
+    """LRU cache of predictions keyed by (model version, scope, perceptual hash).
+
+    A lookup hits on the most recent entry of the same model version and
+    scope whose hash is within max_distance bits of the frame's, so
+    near-duplicate re-scans of the same item skip the forward pass. The
+    scope tells apart frames that must not share a prediction even when they
+    look alike, e.g. different placements on the scale. Entries expire after
+    ttl seconds.
+    """
+
+    def __init__(self, size: int = 16, ttl: float = 30.0, max_distance: int = 4):
+        self.size = size
+        self.ttl = ttl
+        self.max_distance = max_distance
+        self.entries = OrderedDict()  # key -> (stored_at, prediction)
+        self.lock = Lock()
+
+    def get(self, key):
+        if not self.size:
+            return None
+        version, scope, frame_hash = key
+        now = time.monotonic()
+        with self.lock:
+            for stored_key in reversed(self.entries):
+                stored_at, prediction = self.entries[stored_key]
+                if now - stored_at > self.ttl:
+                    continue
+                stored_version, stored_scope, stored_hash = stored_key
+                if stored_version != version or stored_scope != scope:
+                    continue
+                if bin(stored_hash ^ frame_hash).count("1") <= self.max_distance:
+                    self.entries.move_to_end(stored_key)
+                    return prediction
+        return None
+
+    def put(self, key, prediction):
+        if not self.size:
+            return
+        now = time.monotonic()
+        with self.lock:
+            self.entries[key] = (now, prediction)
+            self.entries.move_to_end(key)
+            for stale in [k for k, (t, _) in self.entries.items() if now - t > self.ttl]:
+                del self.entries[stale]
+            while len(self.entries) > self.size:
+                self.entries.popitem(last=False)
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
@@ -1,16 +1,83 @@
 import torch
+import torch.nn as nn
 import torchvision.transforms as transforms
 from torchvision import models
 from PIL import Image
+from dataclasses import dataclass, field, replace
 import os
+from classifier.cache import PredictionCache, dhash
+
+
+@dataclass
+class Prediction:
+    label: int
+    confidence: float
+    top_k: list = field(default_factory=list)  # [(label, probability), ...]
+    stage: str = "fast"  # which model of a cascade answered
+
+
+def load_checkpoint(path: str) -> nn.Module:
+    """Load a whole pickled model, or a train.py checkpoint into a ResNet18."""
+    obj = torch.load(path, map_location=torch.device("cpu"), weights_only=False)
+    if isinstance(obj, dict) and "model_state_dict" in obj:
+        model = models.resnet18()
+        model.fc = nn.Linear(model.fc.in_features, len(obj["class_names"]))
+        model.load_state_dict(obj["model_state_dict"])
+        obj = model
+    obj.eval()
+    return obj
+
+
+def num_outputs(model: nn.Module) -> int:
+    """Number of classes a model predicts, from a dummy forward pass."""
+    with torch.no_grad():
+        return model(torch.zeros(1, 3, 224, 224)).shape[-1]
+
+
+def to_prediction(logits: torch.Tensor, top_k: int = 3, stage: str = "fast") -> Prediction:
+    probs = torch.softmax(logits.flatten(), 0)
+    values, indices = torch.topk(probs, min(top_k, probs.numel()))
+    ranked = [(int(i), float(v)) for v, i in zip(values, indices)]
+    return Prediction(ranked[0][0], ranked[0][1], ranked, stage)
+
+
+def combine_logits(
+    logits: torch.Tensor, mode: str = "mean", top_k: int = 3, stage: str = "fast"
+) -> Prediction:
+    """Fuse the logits of several frames of the same product into one prediction.
+
+    "mean" averages the logits; "vote" takes the label most frames agree on,
+    breaking ties and ranking by mean probability. Confidence in vote mode is
+    the mean probability of the winning label across frames.
+    """
+    if mode == "mean":
+        return to_prediction(logits.mean(0), top_k, stage)
+    if mode != "vote":
+        raise ValueError(f"Unknown burst mode: {mode}")
+
+    probs = torch.softmax(logits, 1)
+    mean_probs = probs.mean(0)
+    votes = torch.bincount(probs.argmax(1), minlength=probs.shape[1]).float()
+    # Mean probabilities are < 1, so they only order labels with equal votes
+    _, indices = torch.topk(votes + mean_probs, min(top_k, votes.numel()))
+    ranked = [(int(i), float(mean_probs[i])) for i in indices]
+    return Prediction(ranked[0][0], ranked[0][1], ranked, stage)
 
 
 class ImageClassifier:
-    def __init__(self, model_path="files/model.pt", version_path="files/v.txt"):
+    def __init__(
+        self,
+        model_path="files/model.pt",
+        version_path="files/v.txt",
+        cache_size: int = 16,
+        cache_ttl: float = 30.0,
+        cache_distance: int = 4,
+    ):
         self.model_path = model_path
         self.version_path = version_path
         self.model = None
         self.version = "NONE"
+        self.cache = PredictionCache(cache_size, cache_ttl, cache_distance)
         self.transform = transforms.Compose([
             transforms.Resize((224, 224)),
             transforms.ToTensor(),
@@ -19,6 +86,7 @@ class ImageClassifier:
         self.load_model()
 
     def load_model(self):
+        self.cache.clear()
         try:
             with open(self.version_path, "r") as f:
                 self.version = f.read().strip()
@@ -28,27 +96,170 @@ class ImageClassifier:
             self.version = "UNKNOWN"
 
         try:
-            self.model = torch.load(self.model_path, map_location=torch.device("cpu"), weights_only=False)
-            self.model.eval()
+            self.model = load_checkpoint(self.model_path)
         except Exception as e:
             # Could log or print the error if needed
             print(f"Could not load model: {e}")
             self.model = None
 
-    def classify_image(self, image_path: str) -> int:
+    def load_image(self, image_path) -> Image.Image:
+        """Decode an image given as a path or a file-like object."""
+        if isinstance(image_path, str) and not os.path.exists(image_path):
+            raise FileNotFoundError(f"Image not found: {image_path}")
+
+        return Image.open(image_path).convert("RGB")
+
+    def to_tensor(self, image: Image.Image) -> torch.Tensor:
+        return self.transform(image).unsqueeze(0)
+
+    def preprocess(self, image_path) -> torch.Tensor:
+        return self.to_tensor(self.load_image(image_path))
+
+    def cache_version(self) -> str:
+        """Identity of the models behind a prediction, for cache keys."""
+        return self.version
+
+    def cache_key(self, image: Image.Image, scope=None):
+        return (self.cache_version(), scope, dhash(image))
+
+    def cached(self, key):
+        """Prediction of a near-identical recent frame, marked as such, or None."""
+        prediction = self.cache.get(key)
+        return replace(prediction, stage="cache") if prediction else None
+
+    def forward(self, tensor: torch.Tensor) -> torch.Tensor:
         if self.model is None:
             raise RuntimeError("Model not loaded. Cannot classify image.")
 
-        if not os.path.exists(image_path):
-            raise FileNotFoundError(f"Image not found: {image_path}")
+        with torch.no_grad():
+            return self.model(tensor)
 
-        image = Image.open(image_path).convert("RGB")
-        tensor = self.transform(image).unsqueeze(0)
+    def predict(self, tensor: torch.Tensor, top_k: int = 3) -> Prediction:
+        return to_prediction(self.forward(tensor), top_k)
 
-        with torch.no_grad():
-            outputs = self.model(tensor)
-            _, predicted = torch.max(outputs, 1)
-            return int(predicted.item())
+    def to_tensors(self, frames: list) -> list:
+        """Tensors of frames given as tensors, paths or file-like objects."""
+        return [f if isinstance(f, torch.Tensor) else self.preprocess(f) for f in frames]
+
+    def predict_burst(
+        self,
+        frames: list,
+        mode: str = "mean",
+        early_exit: float = 0.9,
+        top_k: int = 3,
+    ) -> Prediction:
+        """Classify a burst of frames of the same product.
+
+        The first frame is classified alone and returned if it is at least
+        early_exit confident; otherwise the remaining frames go through one
+        batched forward pass and all frames are combined. Frames may be
+        given undecoded, so the rest are only preprocessed when needed; they
+        are replaced by their tensors in frames once decoded.
+        """
+        frames[:1] = self.to_tensors(frames[:1])
+        first = self.forward(frames[0])
+        prediction = to_prediction(first, top_k)
+        if len(frames) == 1 or prediction.confidence >= early_exit:
+            return prediction
+
+        frames[1:] = self.to_tensors(frames[1:])
+        logits = torch.cat([first, self.forward(torch.cat(frames[1:]))])
+        return combine_logits(logits, mode, top_k)
+
+    def classify_image(self, image_path: str, top_k: int = 3, scope=None) -> Prediction:
+        """Classify an image; the cache is only used within a given scope."""
+        if self.model is None:
+            raise RuntimeError("Model not loaded. Cannot classify image.")
+
+        image = self.load_image(image_path)
+        if scope is None:
+            return self.predict(self.to_tensor(image), top_k)
+
+        key = self.cache_key(image, scope)
+        prediction = self.cached(key)
+        if prediction is None:
+            prediction = self.predict(self.to_tensor(image), top_k)
+            self.cache.put(key, prediction)
+        return prediction
+
+    def warm_up(self):
+        """Run a dummy forward pass so the first scan does not pay lazy init."""
+        if self.model is not None:
+            self.forward(torch.zeros(1, 3, 224, 224))
 
     def get_version(self) -> str:
         return self.version
+
+
+class CascadeClassifier(ImageClassifier):
+    """Early-exit cascade of a small fast model and a heavier fallback.
+
+    The fast model (e.g. quantized MobileNetV2, distributed by the main
+    server as usual) answers when its softmax confidence reaches threshold;
+    otherwise the heavy model (e.g. the ResNet18 from train.py) is run on the
+    same tensor. Both models must share the same label indices; the heavy
+    model is not distributed by the main server, so the cascade is disabled
+    when a pushed fast model predicts a different number of classes.
+    """
+
+    def __init__(
+        self,
+        model_path="files/model.pt",
+        version_path="files/v.txt",
+        heavy_model_path="files/heavy_model.pt",
+        threshold: float = 0.8,
+        **kwargs,
+    ):
+        self.heavy_model_path = heavy_model_path
+        self.heavy_model = None
+        self.heavy_version = None
+        self.threshold = threshold
+        super().__init__(model_path, version_path, **kwargs)
+
+    def load_model(self):
+        super().load_model()
+        self.heavy_model = self.heavy_version = None
+        try:
+            heavy_model = load_checkpoint(self.heavy_model_path)
+            if self.model is not None:
+                fast, heavy = num_outputs(self.model), num_outputs(heavy_model)
+                if fast != heavy:
+                    raise ValueError(f"{heavy} classes, fast model has {fast}")
+            st = os.stat(self.heavy_model_path)
+            self.heavy_model = heavy_model
+            self.heavy_version = f"{st.st_size}-{st.st_mtime_ns}"
+        except Exception as e:
+            print(f"Could not load heavy model, cascade disabled: {e}")
+
+    def cache_version(self) -> str:
+        return f"{self.version}+{self.heavy_version}"
+
+    def warm_up(self):
+        super().warm_up()
+        if self.heavy_model is not None:
+            with torch.no_grad():
+                self.heavy_model(torch.zeros(1, 3, 224, 224))
+
+    def predict(self, tensor: torch.Tensor, top_k: int = 3) -> Prediction:
+        prediction = super().predict(tensor, top_k)
+        if prediction.confidence >= self.threshold or self.heavy_model is None:
+            return prediction
+
+        with torch.no_grad():
+            return to_prediction(self.heavy_model(tensor), top_k, stage="heavy")
+
+    def predict_burst(
+        self,
+        frames: list,
+        mode: str = "mean",
+        early_exit: float = 0.9,
+        top_k: int = 3,
+    ) -> Prediction:
+        frames = list(frames)
+        prediction = super().predict_burst(frames, mode, early_exit, top_k)
+        if prediction.confidence >= self.threshold or self.heavy_model is None:
+            return prediction
+
+        with torch.no_grad():
+            logits = self.heavy_model(torch.cat(self.to_tensors(frames)))
+        return combine_logits(logits, mode, top_k, stage="heavy")
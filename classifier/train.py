@@ -1,8 +1,11 @@
 import os
+import json
+import time
+import numpy as np
 import torch
 import torch.nn as nn
 from torchvision import datasets, models, transforms
-from torch.utils.data import DataLoader
+from torch.utils.data import DataLoader, Dataset
 
 # === CONFIG === #
 data_dir = "dataset"
@@ -10,65 +13,211 @@ model_path = "product_classifier.pth"
 batch_size = 16
 num_epochs = 5
 learning_rate = 0.0005
+image_size = 224
+num_workers = min(8, os.cpu_count() or 1)
+use_cache = True  # Pre-decode resized images once into a uint8 memmap
+cache_dir = os.path.join(data_dir, ".cache")
+channels_last = True
+use_bf16 = True  # bf16 autocast on CPU, and on GPUs that support it
+
+mean = torch.tensor([0.485, 0.456, 0.406]).view(1, 3, 1, 1) * 255
+std = torch.tensor([0.229, 0.224, 0.225]).view(1, 3, 1, 1) * 255
 
 # === TRANSFORMS === #
 data_transforms = {
     'train': transforms.Compose([
-        transforms.Resize((224, 224)),
+        transforms.Resize((image_size, image_size)),
         transforms.RandomHorizontalFlip(),
         transforms.ToTensor(),
         transforms.Normalize([0.485, 0.456, 0.406], [0.229, 0.224, 0.225])
     ]),
     'val': transforms.Compose([
-        transforms.Resize((224, 224)),
+        transforms.Resize((image_size, image_size)),
         transforms.ToTensor(),
         transforms.Normalize([0.485, 0.456, 0.406], [0.229, 0.224, 0.225])
     ]),
 }
+# Cache path: decode and resize only, the rest runs on whole batches
+decode_transform = transforms.Compose([
+    transforms.Resize((image_size, image_size)),
+    transforms.PILToTensor(),
+])
+
+
+# === PRE-DECODED CACHE === #
+class CachedImages(Dataset):
+    """Resized uint8 CHW images in a memmap, opened lazily in each worker."""
+
+    def __init__(self, path, labels, count):
+        self.path = path
+        self.labels = torch.from_numpy(labels)
+        self.count = count
+        self.images = None
+
+    def __len__(self):
+        return self.count
+
+    def __getitem__(self, idx):
+        if self.images is None:
+            self.images = np.memmap(
+                self.path, dtype=np.uint8, mode="r",
+                shape=(self.count, 3, image_size, image_size),
+            )
+        return torch.from_numpy(np.array(self.images[idx])), self.labels[idx]
+
+
+def build_cache(split):
+    folder = datasets.ImageFolder(os.path.join(data_dir, split), decode_transform)
+    os.makedirs(cache_dir, exist_ok=True)
+    path = os.path.join(cache_dir, f"{split}_{image_size}.u8")
+    meta_path = path + ".json"
+    # Size and mtime too, so edited images are decoded again
+    samples = []
+    for sample, _ in folder.samples:
+        st = os.stat(sample)
+        samples.append([sample, st.st_size, st.st_mtime_ns])
+    meta = {"samples": samples, "classes": folder.classes}
+
+    labels = np.array(folder.targets, dtype=np.int64)
+    count = len(folder)
+    if os.path.exists(meta_path):
+        with open(meta_path) as f:
+            if json.load(f) == meta:
+                return CachedImages(path, labels, count), folder.classes
+
+    print(f"Decoding {count} {split} images into {path}")
+    images = np.memmap(
+        path, dtype=np.uint8, mode="w+", shape=(count, 3, image_size, image_size)
+    )
+    loader = DataLoader(folder, batch_size=64, num_workers=num_workers)
+    offset = 0
+    for batch, _ in loader:
+        images[offset:offset + len(batch)] = batch.numpy()
+        offset += len(batch)
+    images.flush()
+    del images
+    with open(meta_path, "w") as f:
+        json.dump(meta, f)
+    return CachedImages(path, labels, count), folder.classes
+
+
+def prepare_batch(inputs, train):
+    """uint8 batch -> augmented, normalized float batch on device."""
+    inputs = inputs.to(device, non_blocking=True).float()
+    if train:
+        flip = torch.rand(inputs.shape[0], 1, 1, 1, device=device) < 0.5
+        inputs = torch.where(flip, inputs.flip(3), inputs)
+    inputs = (inputs - mean.to(device)) / std.to(device)
+    if channels_last:
+        inputs = inputs.contiguous(memory_format=torch.channels_last)
+    return inputs
 
-# === DATASETS AND LOADERS === #
-image_datasets = {
-    x: datasets.ImageFolder(os.path.join(data_dir, x), data_transforms[x])
-    for x in ['train', 'val']
-}
-dataloaders = {
-    x: DataLoader(image_datasets[x], batch_size=batch_size, shuffle=True)
-    for x in ['train', 'val']
-}
-class_names = image_datasets['train'].classes
-num_classes = len(class_names)
 
-# === MODEL SETUP === #
 device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
-model = models.resnet18(pretrained=True)
-model.fc = nn.Linear(model.fc.in_features, num_classes)
-model = model.to(device)
-
-criterion = nn.CrossEntropyLoss()
-optimizer = torch.optim.Adam(model.parameters(), lr=learning_rate)
-
-# === TRAINING LOOP === #
-for epoch in range(num_epochs):
-    print(f"Epoch {epoch+1}/{num_epochs}")
-    model.train()
-    running_loss = 0.0
-    for inputs, labels in dataloaders['train']:
-        inputs, labels = inputs.to(device), labels.to(device)
-
-        optimizer.zero_grad()
-        outputs = model(inputs)
-        loss = criterion(outputs, labels)
-        loss.backward()
-        optimizer.step()
-
-        running_loss += loss.item()
-
-    avg_loss = running_loss / len(dataloaders['train'])
-    print(f"Training loss: {avg_loss:.4f}")
-
-# === SAVE MODEL AND LABELS === #
-torch.save({
-    'model_state_dict': model.state_dict(),
-    'class_names': class_names
-}, model_path)
-print(f"Model saved to {model_path}")
+
+if __name__ == "__main__":
+    # === DATASETS AND LOADERS === #
+    if use_cache:
+        image_datasets, classes = {}, {}
+        for x in ['train', 'val']:
+            image_datasets[x], classes[x] = build_cache(x)
+        class_names = classes['train']
+    else:
+        image_datasets = {
+            x: datasets.ImageFolder(os.path.join(data_dir, x), data_transforms[x])
+            for x in ['train', 'val']
+        }
+        class_names = image_datasets['train'].classes
+
+    dataloaders = {
+        x: DataLoader(
+            image_datasets[x],
+            batch_size=batch_size,
+            shuffle=(x == 'train'),
+            num_workers=num_workers,
+            pin_memory=device.type == "cuda",
+            persistent_workers=num_workers > 0,
+        )
+        for x in ['train', 'val']
+    }
+    num_classes = len(class_names)
+
+    # === MODEL SETUP === #
+    model = models.resnet18(pretrained=True)
+    model.fc = nn.Linear(model.fc.in_features, num_classes)
+    model = model.to(device)
+    if channels_last:
+        model = model.to(memory_format=torch.channels_last)
+
+    criterion = nn.CrossEntropyLoss()
+    optimizer = torch.optim.Adam(model.parameters(), lr=learning_rate)
+
+    bf16 = use_bf16 and (
+        device.type == "cpu"
+        or (device.type == "cuda" and torch.cuda.is_bf16_supported())
+    )
+    if use_bf16 and not bf16:
+        print(f"bf16 not supported on {device}, training in fp32")
+
+    def autocast():
+        return torch.autocast(device.type, dtype=torch.bfloat16, enabled=bf16)
+
+    def to_input(inputs, train):
+        if use_cache:
+            return prepare_batch(inputs, train)
+        inputs = inputs.to(device, non_blocking=True)
+        if channels_last:
+            inputs = inputs.contiguous(memory_format=torch.channels_last)
+        return inputs
+
+    # === TRAINING LOOP === #
+    for epoch in range(num_epochs):
+        print(f"Epoch {epoch+1}/{num_epochs}")
+        model.train()
+        running_loss = 0.0
+        seen = 0
+        start = time.perf_counter()
+        for inputs, labels in dataloaders['train']:
+            inputs = to_input(inputs, train=True)
+            labels = labels.to(device, non_blocking=True)
+
+            optimizer.zero_grad()
+            with autocast():
+                outputs = model(inputs)
+                loss = criterion(outputs, labels)
+            loss.backward()
+            optimizer.step()
+
+            running_loss += loss.item()
+            seen += labels.size(0)
+        elapsed = time.perf_counter() - start
+
+        avg_loss = running_loss / len(dataloaders['train'])
+        print(f"Training loss: {avg_loss:.4f} ({seen / elapsed:.1f} images/s)")
+
+        # === VALIDATION === #
+        model.eval()
+        correct = 0
+        total = 0
+        start = time.perf_counter()
+        with torch.no_grad(), autocast():
+            for inputs, labels in dataloaders['val']:
+                inputs = to_input(inputs, train=False)
+                labels = labels.to(device, non_blocking=True)
+                predicted = model(inputs).argmax(1)
+                correct += (predicted == labels).sum().item()
+                total += labels.size(0)
+        elapsed = time.perf_counter() - start
+        if total:
+            print(
+                f"Validation accuracy: {correct / total:.2%} "
+                f"({total / elapsed:.1f} images/s)"
+            )
+
+    # === SAVE MODEL AND LABELS === #
+    model = model.to(memory_format=torch.contiguous_format)
+    torch.save({
+        'model_state_dict': model.state_dict(),
+        'class_names': class_names
+    }, model_path)
+    print(f"Model saved to {model_path}")
@@ -8,6 +8,8 @@ function App() {
   const [products, setProducts] = useState([]);
   const [selectedProductId, setSelectedProductId] = useState("");
   const [responseMsg, setResponseMsg] = useState("");
+  const [timings, setTimings] = useState(null);
+  const [confidence, setConfidence] = useState(null);
   const [imgRefresh, setImgRefresh] = useState(Date.now());
 
   useEffect(() => {
@@ -55,6 +57,8 @@ function App() {
         setResponseMsg(
           data.status === "correct" ? "✅ OK" : "❌ Not OK, wait for staff"
         );
+        setTimings(data.timings || null);
+        setConfidence(data.confidence ?? null);
         setImgRefresh(Date.now()); // Add a state to re-render image
       })
       .catch((err) => setResponseMsg("❌ Error: " + err.message));
@@ -98,6 +102,19 @@ function App() {
           Send to Server
         </button>
         <p className="text-md">{responseMsg}</p>
+        {confidence !== null && (
+          <p className="text-sm text-gray-600">
+            Confidence: {(confidence * 100).toFixed(1)}%
+          </p>
+        )}
+        {timings && (
+          <p className="text-xs text-gray-500">
+            {Object.entries(timings)
+              .filter(([, ms]) => ms != null)
+              .map(([stage, ms]) => `${stage} ${ms} ms`)
+              .join(" · ")}
+          </p>
+        )}
       </div>
 
       {BACKEND && (
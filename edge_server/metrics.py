@@ -0,0 +1,96 @@
+import time
+from collections import deque
+from contextlib import contextmanager
+from threading import Lock
+
+from prometheus_client import Counter, Gauge, Histogram
+
+# --- SCAN PATH ---
+CAPTURE_SECONDS = Histogram(
+    "edge_capture_seconds", "Time spent taking a photo with the camera"
+)
+PREPROCESS_SECONDS = Histogram(
+    "edge_preprocess_seconds",
+    "Time spent decoding and transforming the photo",
+    buckets=(0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0),
+)
+INFERENCE_SECONDS = Histogram(
+    "edge_inference_seconds", "Time spent in the classifier forward pass"
+)
+UPSTREAM_SECONDS = Histogram(
+    "edge_upstream_seconds", "Round-trip time of the /validate call to main server"
+)
+CONFIDENCE = Histogram(
+    "edge_prediction_confidence",
+    "Softmax confidence of the returned prediction",
+    buckets=(0.3, 0.5, 0.6, 0.7, 0.8, 0.9, 0.95, 0.99, 1.0),
+)
+CASCADE_STAGE = Counter(
+    "edge_cascade_stage_total",
+    "Predictions by what answered: fast, heavy or cache",
+    ["stage"],
+)
+SPECULATIONS = Counter(
+    "edge_speculations_total",
+    "Speculative scans: ready when cached, hit or miss on send",
+    ["outcome"],
+)
+
+VERDICTS = Counter("edge_verdicts_total", "Scan verdicts by result", ["result"])
+MODEL_RELOADS = Counter("edge_model_reloads_total", "Model reloads on this device")
+
+# --- DEVICE STATE ---
+SCALE_SAMPLE_RATE = Gauge(
+    "edge_scale_sample_rate_hz", "Weight samples read from the HX711 per second"
+)
+QUEUE_DEPTH = Gauge("edge_queue_depth", "Scans currently in flight on this device")
+
+
+@contextmanager
+def stage(timeline: dict, name: str, histogram: Histogram = None):
+    """Record the duration of a scan stage in ms into timeline (and histogram)."""
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        elapsed = time.perf_counter() - start
+        timeline[name] = round(elapsed * 1000)
+        if histogram is not None:
+            histogram.observe(elapsed)
+
+
+class ScanStats:
+    """Recent scan durations and scans in flight, summarized for heartbeats."""
+
+    def __init__(self, window: int = 200):
+        self.durations = deque(maxlen=window)  # (finished_at, seconds)
+        self.in_flight = 0
+        self.lock = Lock()
+
+    @contextmanager
+    def track(self):
+        with self.lock:
+            self.in_flight += 1
+        QUEUE_DEPTH.inc()
+        start = time.monotonic()
+        try:
+            yield
+        finally:
+            now = time.monotonic()
+            with self.lock:
+                self.in_flight -= 1
+                self.durations.append((now, now - start))
+            QUEUE_DEPTH.dec()
+
+    def snapshot(self, period: float = 60) -> dict:
+        now = time.monotonic()
+        with self.lock:
+            durations = sorted(d for _, d in self.durations)
+            recent = sum(1 for t, _ in self.durations if now - t <= period)
+            in_flight = self.in_flight
+        p95 = durations[int(0.95 * (len(durations) - 1))] if durations else None
+        return {
+            "scan_rate": round(recent * 60 / period, 2),
+            "queue_depth": in_flight,
+            "p95_ms": round(p95 * 1000) if p95 is not None else None,
+        }
@@ -1,18 +1,25 @@
 import os
 from fastapi import FastAPI, Request, HTTPException
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.responses import HTMLResponse, FileResponse
+from fastapi.responses import HTMLResponse, FileResponse, Response
+from fastapi.concurrency import run_in_threadpool
 import subprocess
-from threading import Thread, Lock
+import glob
+import shutil
+import tempfile
+from threading import Thread, Lock, Event
 import RPi.GPIO as GPIO
 from hx711 import HX711
 import time
+import json
 import requests
 import socket
 from dotenv import load_dotenv
 import uvicorn
 import statistics as st
-from classifier.classifier import ImageClassifier
+from prometheus_client import generate_latest, CONTENT_TYPE_LATEST
+from edge_server import metrics
+from edge_server.speculation import PlacementCache
 
 
 # Load environment variables from a .env file
@@ -34,6 +41,24 @@ DEVICE_NAME = os.getenv("DEVICE_NAME", "rpi1")  # Store shared secret securely
 API_KEY = ""
 API_KEY_FILE = "key.txt"
 MAIN_SERVER_CERT = os.getenv("MAIN_SERVER_CERT", False)
+SETTLE_SECONDS = float(os.getenv("SETTLE_SECONDS", 0.5))
+UPLOAD_IMAGES = os.getenv("UPLOAD_IMAGES", "0") == "1"  # Archive scans on main server
+INFERENCE_MODE = os.getenv("INFERENCE_MODE", "local")  # "local" or "offload"
+CASCADE_MODEL_PATH = os.getenv("CASCADE_MODEL_PATH")  # Heavy fallback model, optional
+CASCADE_THRESHOLD = float(os.getenv("CASCADE_THRESHOLD", 0.8))
+PHASH_CACHE_SIZE = int(os.getenv("PHASH_CACHE_SIZE", 16))  # 0 disables the cache
+PHASH_CACHE_TTL = float(os.getenv("PHASH_CACHE_TTL", 30))
+PHASH_MAX_DISTANCE = int(os.getenv("PHASH_MAX_DISTANCE", 4))
+REGISTER_BACKOFF_MAX = float(os.getenv("REGISTER_BACKOFF_MAX", 60))
+BURST_FRAMES = int(os.getenv("BURST_FRAMES", 1))  # Frames per scan, 1 disables burst
+BURST_INTERVAL_MS = int(os.getenv("BURST_INTERVAL_MS", 100))
+BURST_WARMUP_MS = int(os.getenv("BURST_WARMUP_MS", 1000))  # Let AE/AWB settle first
+BURST_MODE = os.getenv("BURST_MODE", "mean")  # "mean" of logits or majority "vote"
+BURST_EARLY_EXIT = float(os.getenv("BURST_EARLY_EXIT", 0.9))
+HEARTBEAT_INTERVAL = float(os.getenv("HEARTBEAT_INTERVAL", 10))
+AUTO_TRIGGER = os.getenv("AUTO_TRIGGER", "0") == "1"  # Scan ahead on stable weight
+LATEST_PHOTO = "/tmp/product.jpg"
+SCAN_DIR = os.path.join(tempfile.gettempdir(), "scans")  # One subdirectory per capture
 
 # --- FASTAPI SETUP ---
 app = FastAPI()
@@ -48,9 +73,66 @@ app.add_middleware(
 
 current_weight = 0.0
 lock = Lock()
+camera_lock = Lock()
 hx = None
+placement = PlacementCache()
+scan_stats = metrics.ScanStats()
 
-classifier = ImageClassifier()
+# Loaded in the background so the API and scale are up right after boot
+classifier = None
+model_ready = Event()
+model_attempted = Event()  # Set once the first load finished, even if it failed
+registered = Event()
+
+
+def load_classifier():
+    """Import torch, load and warm up the model, then mark the device ready.
+
+    A failure is logged and leaves the device not ready, so the version
+    check after registration can still download a working model.
+    """
+    global classifier
+    start = time.perf_counter()
+    try:
+        from classifier.classifier import ImageClassifier, CascadeClassifier
+
+        cache = dict(
+            cache_size=PHASH_CACHE_SIZE,
+            cache_ttl=PHASH_CACHE_TTL,
+            cache_distance=PHASH_MAX_DISTANCE,
+        )
+        if CASCADE_MODEL_PATH:
+            loaded = CascadeClassifier(
+                heavy_model_path=CASCADE_MODEL_PATH,
+                threshold=CASCADE_THRESHOLD,
+                **cache,
+            )
+        else:
+            loaded = ImageClassifier(**cache)
+        if loaded.model is None:
+            raise RuntimeError("No usable model file")
+        loaded.warm_up()
+        classifier = loaded
+        model_ready.set()
+        print(f"Model ready in {time.perf_counter() - start:.1f}s")
+    except Exception as e:
+        print("Model load failed:", e)
+    finally:
+        model_attempted.set()
+
+
+# --- READINESS ROUTE ---
+@app.get("/ready")
+async def get_ready():
+    ready = registered.is_set() and (
+        model_ready.is_set() or INFERENCE_MODE == "offload"
+    )
+    return {
+        "ready": ready,
+        "model_loaded": model_ready.is_set(),
+        "registered": registered.is_set(),
+        "model_version": classifier.get_version() if classifier else None,
+    }
 
 
 # --- WEIGHT API ROUTE ---
@@ -60,47 +142,282 @@ async def get_weight():
     return {"current_weight": abs(round(current_weight, 1))}
 
 
+# --- METRICS ROUTE ---
+@app.get("/metrics")
+async def get_metrics():
+    return Response(generate_latest(), media_type=CONTENT_TYPE_LATEST)
+
+
 # --- TAKE PHOTO FUNCTION ---
-def take_photo(filename: str = "/tmp/product.jpg") -> str:
+class CaptureError(RuntimeError):
+    """The camera did not deliver a usable photo."""
+
+
+def new_scan_dir(max_age: float = 600) -> str:
+    """Fresh directory for the files of one capture.
+
+    Speculative and manual scans may run concurrently, so each capture gets
+    its own files. Directories of scans that were never sent, e.g. a
+    speculation whose product was taken off the scale, are removed once
+    they are older than max_age seconds.
+    """
+    os.makedirs(SCAN_DIR, exist_ok=True)
+    now = time.time()
+    for name in os.listdir(SCAN_DIR):
+        path = os.path.join(SCAN_DIR, name)
+        try:
+            if now - os.path.getmtime(path) > max_age:
+                shutil.rmtree(path, ignore_errors=True)
+        except OSError:
+            pass
+    return tempfile.mkdtemp(dir=SCAN_DIR)
+
+
+def publish_photo(photo_path: str):
+    """Atomically make photo_path the one served by /latest_photo."""
+    tmp = f"{LATEST_PHOTO}.tmp"
+    shutil.copyfile(photo_path, tmp)
+    os.replace(tmp, LATEST_PHOTO)
+
+
+def take_photo(filename: str) -> str:
     """Take a photo and save to filename."""
     cmd = ["libcamera-jpeg", "-o", filename, "-n", "--width", "640", "--height", "480"]
-    subprocess.run(cmd, check=True)
-    time.sleep(0.5)
+    with camera_lock:
+        subprocess.run(cmd, check=True)
     return filename
 
 
+def take_burst(
+    frames: int,
+    interval_ms: int,
+    filename: str,
+    warmup_ms: int = BURST_WARMUP_MS,
+) -> list[str]:
+    """Take several frames in one camera session; the first is kept as filename.
+
+    Frames are written next to filename, which should be in a directory of
+    its own. The session runs warmup_ms longer than the burst itself and
+    only the last frames are kept, so the ones taken while exposure and
+    white balance were still settling are dropped.
+    """
+    folder = os.path.dirname(filename)
+    pattern = os.path.join(folder, "burst%02d.jpg")
+    cmd = [
+        "libcamera-still", "-o", pattern, "-n", "--width", "640", "--height", "480",
+        "--timelapse", str(interval_ms), "-t", str(warmup_ms + interval_ms * frames),
+    ]
+    with camera_lock:
+        subprocess.run(cmd, check=True)
+    # By frame number, a plain sort puts burst100 before burst11
+    paths = sorted(
+        glob.glob(os.path.join(folder, "burst*.jpg")),
+        key=lambda p: int(os.path.basename(p)[len("burst") : -len(".jpg")]),
+    )[-frames:]
+    if not paths:
+        raise CaptureError("Burst capture produced no frames")
+    if len(paths) < frames:
+        print(f"Burst capture returned {len(paths)} of {frames} frames")
+    shutil.copyfile(paths[0], filename)
+    return paths
+
+
 # --- SEND PRODUCT ROUTE ---
-@app.post("/send_product")
-async def send_product(request: Request):
-    global current_weight
-    data = await request.json()
-    product_id = data.get("product_id", "unknown")
+def classify_local(
+    photo_path: str, timeline: dict, frames: list = None, event: int = None
+):
+    """Classify the photo, or a burst of frames of it.
+
+    The cache is only used for photos of a settled placement (event), so a
+    look-alike product put on the scale next is never given a stale label.
+    """
+    frames = frames or [photo_path]
+    with metrics.stage(timeline, "preprocess", metrics.PREPROCESS_SECONDS):
+        image = classifier.load_image(frames[0])
+        key = prediction = None
+        if event is not None:
+            key = classifier.cache_key(image, scope=event)
+            prediction = classifier.cached(key)
+        if prediction is None:
+            tensor = classifier.to_tensor(image)
+    if prediction is None:
+        # The rest of a burst is decoded only if the first frame is not
+        # confident enough, which is then timed as part of inference
+        with metrics.stage(timeline, "infer", metrics.INFERENCE_SECONDS):
+            if len(frames) == 1:
+                prediction = classifier.predict(tensor)
+            else:
+                prediction = classifier.predict_burst(
+                    [tensor] + frames[1:],
+                    mode=BURST_MODE,
+                    early_exit=BURST_EARLY_EXIT,
+                )
+        if key is not None:
+            classifier.cache.put(key, prediction)
+    metrics.CONFIDENCE.observe(prediction.confidence)
+    metrics.CASCADE_STAGE.labels(stage=prediction.stage).inc()
+    return prediction
+
+
+def post_validate(data: dict, photo_path: str, with_image: bool):
+    files = None
+    if with_image:
+        with open(photo_path, "rb") as f:
+            files = {"image": ("image.jpg", f.read(), "image/jpeg")}
+    return requests.post(
+        f"{MAIN_SERVER_URL}/validate",
+        data=data,
+        files=files,
+        headers={"Authorization": f"Bearer {API_KEY}", "api-key": API_KEY},
+        verify=MAIN_SERVER_CERT,
+    )
 
-    photo_path = take_photo()
 
-    pred_model_label = classifier.classify_image(photo_path)
+def capture_and_classify(timeline: dict):
+    """Take a photo (or burst) and, unless inference is offloaded, classify it."""
+    frames = None
+    event = placement.current()
+    with metrics.stage(timeline, "capture", metrics.CAPTURE_SECONDS):
+        try:
+            photo_path = os.path.join(new_scan_dir(), "product.jpg")
+            if BURST_FRAMES > 1:
+                frames = take_burst(BURST_FRAMES, BURST_INTERVAL_MS, photo_path)
+            else:
+                take_photo(photo_path)
+            publish_photo(photo_path)
+        except (subprocess.CalledProcessError, OSError) as e:
+            raise CaptureError(f"Camera failed: {e}") from e
+    with metrics.stage(timeline, "settle"):
+        time.sleep(SETTLE_SECONDS)
+    if placement.current() != event:
+        event = None  # The load changed while capturing, do not use the cache
+
+    prediction = None
+    if INFERENCE_MODE != "offload":
+        prediction = classify_local(photo_path, timeline, frames, event)
+    return photo_path, prediction
+
+
+def speculate(event: int):
+    """Scan a newly placed product before the operator presses send."""
+    result = None
+    try:
+        result = capture_and_classify({})
+        metrics.SPECULATIONS.labels(outcome="ready").inc()
+    except Exception as e:
+        print("Speculative scan failed:", e)
+    placement.store(event, result)
+
+
+def scan_product(product_id) -> dict:
+    """Capture, classify and validate a single product with the main server.
+
+    Every stage is timed in ms into a timeline, which is sent along to the
+    main server (stored with the incident) and returned to the frontend.
+    With AUTO_TRIGGER, a scan cached for the product on the scale is used
+    instead, and only the wait for it is timed.
+    """
+    timeline = {}
+    cached = None
+    if AUTO_TRIGGER:
+        with metrics.stage(timeline, "wait"):
+            cached = placement.take(current_weight)
+        if cached and not os.path.exists(cached[0]):
+            cached = None  # Its files were swept, the speculation is too old
+        metrics.SPECULATIONS.labels(outcome="hit" if cached else "miss").inc()
+
+    if cached:
+        photo_path, prediction = cached
+    else:
+        try:
+            photo_path, prediction = capture_and_classify(timeline)
+        except CaptureError as e:
+            print("Capture failed:", e)
+            metrics.VERDICTS.labels(result="error").inc()
+            return {"status": "error", "details": str(e), "timings": timeline}
+
+    try:
+        return validate_scan(product_id, photo_path, prediction, timeline, cached)
+    finally:
+        shutil.rmtree(os.path.dirname(photo_path), ignore_errors=True)
+
+
+def validate_scan(product_id, photo_path: str, prediction, timeline: dict, cached):
+    """Classify locally if still needed and validate the scan with main server."""
+    offload = prediction is None and INFERENCE_MODE == "offload"
+    if prediction is None and not offload:
+        # Cached while offloading, but inference has since been switched back
+        prediction = classify_local(photo_path, timeline)
+
     data = {
         "product_id": product_id,
         "weight": str(round(current_weight, 1)),
-        "pred_model_label": pred_model_label,
     }
+    if prediction is not None:
+        data["pred_model_label"] = prediction.label
+    data["timings"] = json.dumps(timeline)
     print(data)
 
     try:
         print("sending request")
-        response = requests.post(
-            f"{MAIN_SERVER_URL}/validate",
-            data=data,
-            headers={"Authorization": f"Bearer {API_KEY}", "api-key": API_KEY},
-            verify=MAIN_SERVER_CERT,
-        )
+        with metrics.stage(timeline, "http", metrics.UPSTREAM_SECONDS):
+            response = post_validate(data, photo_path, UPLOAD_IMAGES or offload)
+        if offload and response.status_code == 503 and model_ready.is_set():
+            # Main server inference queue is full, classify here instead
+            print("Offload refused, classifying locally")
+            prediction = classify_local(photo_path, timeline)
+            data["pred_model_label"] = prediction.label
+            data["timings"] = json.dumps(timeline)
+            with metrics.stage(timeline, "http", metrics.UPSTREAM_SECONDS):
+                response = post_validate(data, photo_path, UPLOAD_IMAGES)
         response.raise_for_status()
         data = response.json()
         print(data)
-        return {"status": data.get("result", "error")}
+        result = data.get("result", "error")
+        timeline["validate"] = data.get("validate_ms")
+        metrics.VERDICTS.labels(result=result).inc()
+        reply = {"status": result, "timings": timeline, "speculative": bool(cached)}
+        if prediction is not None:
+            reply["confidence"] = round(prediction.confidence, 3)
+            reply["top_k"] = prediction.top_k
+            reply["stage"] = prediction.stage
+        return reply
     except requests.exceptions.HTTPError as e:
         print(e.response.text)
-        return {"status": "error", "details": str(e)}
+        metrics.VERDICTS.labels(result="error").inc()
+        return {"status": "error", "details": str(e), "timings": timeline}
+
+
+@app.post("/send_product")
+async def send_product(request: Request):
+    data = await request.json()
+    product_id = data.get("product_id", "unknown")
+
+    if not registered.is_set():
+        return {"status": "error", "details": "Not registered with main server yet"}
+    if INFERENCE_MODE != "offload" and not model_ready.is_set():
+        return {"status": "error", "details": "Model is still loading"}
+
+    # Scans block on the camera and main server, keep them off the event loop
+    with scan_stats.track():
+        return await run_in_threadpool(scan_product, product_id)
+
+
+@app.get("/inference_mode")
+async def get_inference_mode():
+    return {"mode": INFERENCE_MODE}
+
+
+@app.post("/inference_mode")
+async def set_inference_mode(request: Request):
+    """Switch between classifying locally and offloading to main server."""
+    global INFERENCE_MODE
+    data = await request.json()
+    mode = data.get("mode")
+    if mode not in ("local", "offload"):
+        raise HTTPException(status_code=400, detail="Mode must be local or offload")
+    INFERENCE_MODE = mode
+    return {"mode": INFERENCE_MODE}
 
 
 @app.get("/get_products")
@@ -127,6 +444,7 @@ def run_scale(x0: int = -837_500, x1: int = 84_500) -> None:
 
     try:
         global current_weight
+        last = time.perf_counter()
 
         while True:
             with lock:
@@ -136,6 +454,16 @@ def run_scale(x0: int = -837_500, x1: int = 84_500) -> None:
                 gain = mw / (x1 - x0)
                 current_weight = gain * (avg - x0)
 
+            now = time.perf_counter()
+            metrics.SCALE_SAMPLE_RATE.set(len(reading) / (now - last))
+            last = now
+
+            event = placement.update(current_weight)
+            can_scan = model_ready.is_set() or INFERENCE_MODE == "offload"
+            if event is not None and AUTO_TRIGGER and can_scan:
+                placement.begin(event)
+                Thread(target=speculate, args=(event,), daemon=True).start()
+
             time.sleep(0.2)
             # print(current_weight)
 
@@ -145,7 +473,7 @@ def run_scale(x0: int = -837_500, x1: int = 84_500) -> None:
 
 @app.get("/latest_photo")
 async def latest_photo():
-    filepath = "/tmp/product.jpg"
+    filepath = LATEST_PHOTO
     if os.path.exists(filepath):
         return FileResponse(filepath, media_type="image/jpeg")
     else:
@@ -219,6 +547,44 @@ def unregister():
 #     unregister()
 
 
+def register_with_retry():
+    """Keep registering with exponential backoff until main server answers."""
+    delay = 1.0
+    while True:
+        try:
+            register()
+            break
+        except Exception as e:
+            print(f"Registration failed, retrying in {delay:.0f}s:", e)
+            time.sleep(delay)
+            delay = min(delay * 2, REGISTER_BACKOFF_MAX)
+    registered.set()
+
+    # Compare against the local model once it loaded, or download one if it failed
+    model_attempted.wait()
+    update_model()
+
+
+def send_heartbeats():
+    """Report model version and scan stats to main server every interval."""
+    registered.wait()
+    while True:
+        data = scan_stats.snapshot()
+        data["model_version"] = classifier.get_version() if classifier else None
+        try:
+            r = requests.post(
+                f"{MAIN_SERVER_URL}/heartbeat",
+                data={k: v for k, v in data.items() if v is not None},
+                headers={"api-key": API_KEY},
+                verify=MAIN_SERVER_CERT,
+                timeout=5,
+            )
+            r.raise_for_status()
+        except Exception as e:
+            print("Heartbeat failed:", e)
+        time.sleep(HEARTBEAT_INTERVAL)
+
+
 def update_model():
     try:
         version_url = f"{MAIN_SERVER_URL}/get_model_version"
@@ -226,9 +592,9 @@ def update_model():
         data = r.json()
         version = str(data.get("version", "unknown")).lower()
 
-        current_version = classifier.get_version()
+        current_version = classifier.get_version() if classifier else None
 
-        if current_version.lower() != str(version):
+        if current_version is None or current_version.lower() != str(version):
             print(f"Updating model to version {version}")
             model_url = f"{MAIN_SERVER_URL}/get_model"
             r = requests.get(model_url, verify=MAIN_SERVER_CERT)
@@ -236,7 +602,12 @@ def update_model():
                 f.write(r.content)
             with open("files/v.txt", "w") as f:
                 f.write(version)
-            classifier.load_model()
+            if classifier is None:
+                load_classifier()  # The local model never loaded, try the new one
+            else:
+                classifier.load_model()
+                classifier.warm_up()
+            metrics.MODEL_RELOADS.inc()
     except Exception as e:
         print("Model update failed:", e)
 
@@ -250,10 +621,9 @@ async def trigger_model_update():
         return {"status": "error", "message": str(e)}
 
 
-# --- START SCALE THREAD ---
-register()
-update_model()
-thread = Thread(target=run_scale)
-thread.daemon = True
-thread.start()
+# --- START BACKGROUND THREADS ---
+for target in (run_scale, load_classifier, register_with_retry, send_heartbeats):
+    thread = Thread(target=target)
+    thread.daemon = True
+    thread.start()
 uvicorn.run(app=app, host="0.0.0.0", port=8000)
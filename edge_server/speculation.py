@@ -0,0 +1,95 @@
+from collections import deque
+from threading import Event, Lock
+
+
+class PlacementCache:
+    """Detects new stable loads on the scale and caches one scan per placement.
+
+    The scale thread feeds every weight sample to update(). Once the last
+    window samples agree within tolerance on a load of at least min_load
+    grams, a new placement event is started. If the caller captures and
+    classifies ahead of time, it calls begin() first and hands the result to
+    store(). Any later sample that moves away from the stable weight
+    discards the cached result.
+    """
+
+    def __init__(self, tolerance: float = 3.0, min_load: float = 5.0, window: int = 5):
+        self.tolerance = tolerance
+        self.min_load = min_load
+        self.samples = deque(maxlen=window)
+        self.lock = Lock()
+        self.event = 0
+        self.stable_weight = None
+        self.result = None
+        self.done = Event()
+        self.done.set()
+
+    def update(self, weight: float):
+        """Feed a weight sample; returns a new placement event id, or None."""
+        weight = abs(weight)
+        self.samples.append(weight)
+        with self.lock:
+            if (
+                self.stable_weight is not None
+                and abs(weight - self.stable_weight) > self.tolerance
+            ):
+                # Load changed, the cached scan belongs to another placement
+                self.stable_weight = None
+                self.result = None
+
+            if self.stable_weight is not None:
+                return None
+            if len(self.samples) < self.samples.maxlen:
+                return None
+            if max(self.samples) - min(self.samples) > self.tolerance:
+                return None
+            mean = sum(self.samples) / len(self.samples)
+            if mean < self.min_load:
+                return None
+
+            self.event += 1
+            self.stable_weight = mean
+            self.result = None
+            # Nothing in flight for this placement until begin() is called
+            self.done.set()
+            return self.event
+
+    def begin(self, event: int):
+        """Mark a speculative scan of event as in flight, so take() waits for it."""
+        with self.lock:
+            if event == self.event:
+                self.done.clear()
+
+    def current(self):
+        """Event id of the load resting on the scale, or None while unsettled."""
+        with self.lock:
+            return self.event if self.stable_weight is not None else None
+
+    def store(self, event: int, result):
+        """Keep a speculative result if its placement is still on the scale."""
+        with self.lock:
+            if event != self.event:
+                return
+            if self.stable_weight is not None:
+                self.result = result
+            self.done.set()
+
+    def take(self, weight: float, timeout: float = 5.0):
+        """Return the cached result for the current load, waiting for one in flight.
+
+        Each result is handed out once; returns None on a miss.
+        """
+        with self.lock:
+            if (
+                self.stable_weight is None
+                or abs(abs(weight) - self.stable_weight) > self.tolerance
+            ):
+                return None
+            event = self.event
+
+        self.done.wait(timeout)
+        with self.lock:
+            if event != self.event or self.stable_weight is None:
+                return None
+            result, self.result = self.result, None
+            return result
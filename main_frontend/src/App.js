@@ -20,7 +20,10 @@ function App() {
     fetchIncidents();
     fetchProducts();
     fetchDevices();
-    const interval = setInterval(fetchIncidents, 10000);
+    const interval = setInterval(() => {
+      fetchIncidents();
+      fetchDevices();
+    }, 10000);
     return () => clearInterval(interval);
   }, []);
 
@@ -46,7 +49,7 @@ function App() {
 
   const fetchDevices = async () => {
     try {
-      const res = await fetch(`${SERVER_URL}/get_devices`);
+      const res = await fetch(`${SERVER_URL}/fleet`);
       const data = await res.json();
       setDevices(data);
     } catch (err) {
@@ -178,11 +181,22 @@ function App() {
         <h2 className="text-xl font-semibold mb-2">Last 10 Incidents</h2>
         <ul className="space-y-1 text-gray-700">
           {incidents.map((i, idx) => (
-            <li key={idx}>
-              [{new Date(i.timestamp).toLocaleString()}] {i.product} -{" "}
-              {i.weight}g -{" "}
-              <span className="font-semibold">{i.result.toUpperCase()}</span>{" "}
-              (Device: {i.device})
+            <li key={idx} className="flex items-center gap-2">
+              {i.image && (
+                <a href={`${SERVER_URL}/incidents/${i.id}/image`}>
+                  <img
+                    src={`${SERVER_URL}/incidents/${i.id}/thumbnail`}
+                    alt=""
+                    className="w-12 h-12 object-cover rounded border"
+                  />
+                </a>
+              )}
+              <span>
+                [{new Date(i.timestamp).toLocaleString()}] {i.product} -{" "}
+                {i.weight}g -{" "}
+                <span className="font-semibold">{i.result.toUpperCase()}</span>{" "}
+                (Device: {i.device})
+              </span>
             </li>
           ))}
         </ul>
@@ -248,7 +262,15 @@ function App() {
           <ul className="list-disc pl-6 space-y-1 text-gray-700">
             {devices.map((d) => (
               <li key={d.id} className="flex items-center justify-between">
-                {d.name}
+                <span>
+                  <span className={d.online ? "text-green-600" : "text-gray-400"}>
+                    ●
+                  </span>{" "}
+                  {d.name}
+                  {d.model_version && ` (model v${d.model_version})`}
+                  {d.online &&
+                    ` - ${d.scan_rate ?? 0} scans/min, p95 ${d.p95_ms ?? "-"} ms, queue ${d.queue_depth ?? 0}`}
+                </span>
                 <button
                   onClick={() => handleRemoveDevice(d.id)}
                   className="ml-4 px-2 py-1 bg-red-600 text-white rounded hover:bg-red-700"
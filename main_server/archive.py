@@ -0,0 +1,164 @@
+import hashlib
+import os
+import queue
+import tempfile
+import time
+from threading import Thread
+
+from PIL import Image
+
+from main_server import metrics
+
+CHUNK_SIZE = 64 * 1024
+
+
+class ImageArchive:
+    """Content-addressed scan image store, written by a background worker.
+
+    Images are named by the sha256 of their bytes, so re-uploads of the same
+    frame are stored once. The request path spools the upload to a file in
+    the archive while hashing it and enqueues that file; the worker moves it
+    into place (or drops a duplicate), writes a small thumbnail, and applies
+    retention. Queued images therefore cost disk space, not memory.
+    """
+
+    def __init__(
+        self,
+        root: str,
+        max_bytes: int = 1024**3,
+        max_age_days: float = 30,
+        thumb_size: int = 128,
+        queue_size: int = 64,
+        sweep_interval: float = 600,
+    ):
+        self.root = root
+        self.thumb_root = os.path.join(root, "thumbs")
+        self.spool_root = os.path.join(root, "incoming")
+        self.max_bytes = max_bytes
+        self.max_age = max_age_days * 24 * 3600
+        self.thumb_size = thumb_size
+        self.sweep_interval = sweep_interval
+        self.queue = queue.Queue(maxsize=queue_size)
+        os.makedirs(self.thumb_root, exist_ok=True)
+        os.makedirs(self.spool_root, exist_ok=True)
+
+    def start(self):
+        # Nothing is queued yet, so spooled files are leftovers of a crash
+        for name in os.listdir(self.spool_root):
+            os.remove(os.path.join(self.spool_root, name))
+        thread = Thread(target=self._run)
+        thread.daemon = True
+        thread.start()
+
+    # --- REQUEST PATH ---
+    def spool(self, fileobj, max_size: int) -> tuple[str, str]:
+        """Copy an upload in chunks to a spool file, returning its sha256 and path."""
+        digest = hashlib.sha256()
+        size = 0
+        fd, tmp = tempfile.mkstemp(dir=self.spool_root, suffix=".upload")
+        try:
+            with os.fdopen(fd, "wb") as f:
+                while chunk := fileobj.read(CHUNK_SIZE):
+                    size += len(chunk)
+                    if size > max_size:
+                        raise ValueError(f"Image larger than {max_size} bytes")
+                    digest.update(chunk)
+                    f.write(chunk)
+        except BaseException:
+            os.remove(tmp)
+            raise
+        return digest.hexdigest(), tmp
+
+    def submit(self, digest: str, spooled: str) -> bool:
+        """Queue a spooled image for storage; drops it if the worker is behind."""
+        try:
+            self.queue.put_nowait((digest, spooled))
+        except queue.Full:
+            os.remove(spooled)
+            metrics.ARCHIVE_DROPPED.inc()
+            print(f"Archive queue full, dropping image {digest[:12]}")
+            return False
+        metrics.ARCHIVE_QUEUE_DEPTH.set(self.queue.qsize())
+        return True
+
+    def path(self, digest: str) -> str:
+        return os.path.join(self.root, digest[:2], f"{digest}.jpg")
+
+    def thumb_path(self, digest: str) -> str:
+        return os.path.join(self.thumb_root, f"{digest}.jpg")
+
+    # --- WORKER ---
+    def _run(self):
+        last_sweep = 0.0
+        while True:
+            try:
+                digest, spooled = self.queue.get(timeout=self.sweep_interval)
+            except queue.Empty:
+                digest = None
+            metrics.ARCHIVE_QUEUE_DEPTH.set(self.queue.qsize())
+
+            if digest is not None:
+                try:
+                    self._store(digest, spooled)
+                except Exception as e:
+                    print(f"Could not archive image {digest[:12]}: {e}")
+                    if os.path.exists(spooled):
+                        os.remove(spooled)
+
+            if time.monotonic() - last_sweep >= self.sweep_interval:
+                try:
+                    self.sweep()
+                except Exception as e:
+                    print(f"Archive sweep failed: {e}")
+                last_sweep = time.monotonic()
+
+    def _store(self, digest: str, spooled: str):
+        path = self.path(digest)
+        if os.path.exists(path):
+            # Duplicate: refresh its age so retention keeps recent scans
+            os.utime(path)
+            os.remove(spooled)
+            return
+
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        os.replace(spooled, path)
+
+        with Image.open(path) as image:
+            image.draft("RGB", (self.thumb_size, self.thumb_size))
+            image = image.convert("RGB")
+            image.thumbnail((self.thumb_size, self.thumb_size))
+            image.save(self.thumb_path(digest), "JPEG", quality=80)
+
+    def sweep(self):
+        """Delete images past max age, then oldest first until under max bytes."""
+        blobs = []
+        for dirpath, _, filenames in os.walk(self.root):
+            if dirpath == self.thumb_root:
+                continue
+            for name in filenames:
+                if not name.endswith(".jpg"):
+                    continue
+                path = os.path.join(dirpath, name)
+                st = os.stat(path)
+                blobs.append((st.st_mtime, st.st_size, name[:-4]))
+
+        blobs.sort()
+        total = sum(size for _, size, _ in blobs)
+        cutoff = time.time() - self.max_age
+        removed = 0
+        for mtime, size, digest in blobs:
+            if mtime >= cutoff and total <= self.max_bytes:
+                break
+            self._remove(digest)
+            total -= size
+            removed += 1
+
+        if removed:
+            print(f"Archive sweep removed {removed} images")
+
+    def _remove(self, digest: str):
+        for path in (self.path(digest), self.thumb_path(digest)):
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
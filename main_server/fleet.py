@@ -0,0 +1,185 @@
+import time
+from datetime import datetime
+from threading import Lock, Thread
+
+from fastapi import Header, HTTPException
+
+from main_server import metrics
+from main_server.db import SessionLocal
+from main_server.models import Device, DeviceStatus
+
+
+class FleetRegistry:
+    """Coalesces device heartbeats in memory and flushes aggregates periodically.
+
+    A heartbeat only updates this device's entry under a lock: the latest
+    model version, scan rate and p95 latency, and the peak queue depth since
+    the last flush. Every flush_interval seconds the devices that sent
+    heartbeats are written in one transaction, so DB load does not grow with
+    heartbeat frequency. API keys are cached too, so heartbeats do not hit
+    the DB for authentication either.
+    """
+
+    def __init__(self, flush_interval: float = 30, stale_after: float = 60):
+        self.flush_interval = flush_interval
+        self.stale_after = stale_after
+        self.lock = Lock()
+        self.state = {}  # device_id -> dict
+        self.dirty = set()
+        self.keys = {}  # api_key -> (device_id, device_name)
+
+    # --- AUTH ---
+    def authenticate(self, api_key: str):
+        with self.lock:
+            device = self.keys.get(api_key)
+        if device is not None:
+            return device
+
+        db = SessionLocal()
+        try:
+            row = db.query(Device).filter_by(api_key=api_key).first()
+        finally:
+            db.close()
+        if row is None:
+            raise HTTPException(status_code=403, detail="Invalid API key")
+        with self.lock:
+            self.keys[api_key] = (row.id, row.name)
+        return row.id, row.name
+
+    def forget(self, device_id: int | None = None):
+        """Drop cached keys (and live state) of a device, or of all devices."""
+        with self.lock:
+            if device_id is None:
+                self.keys.clear()
+                self.state.clear()
+                self.dirty.clear()
+                return
+            for key, (cached_id, _) in list(self.keys.items()):
+                if cached_id == device_id:
+                    del self.keys[key]
+            self.state.pop(device_id, None)
+            self.dirty.discard(device_id)
+
+    # --- HEARTBEATS ---
+    def heartbeat(self, device_id: int, name: str, status: dict):
+        metrics.HEARTBEATS.inc()
+        with self.lock:
+            entry = self.state.get(device_id)
+            if entry is None:
+                entry = self.state[device_id] = {
+                    "name": name,
+                    "heartbeats": 0,
+                    "peak_queue_depth": 0,
+                }
+            entry.update(status)
+            entry["last_seen"] = datetime.utcnow()
+            entry["heartbeats"] += 1
+            entry["peak_queue_depth"] = max(
+                entry["peak_queue_depth"], status.get("queue_depth") or 0
+            )
+            self.dirty.add(device_id)
+
+    def status(self, db) -> list[dict]:
+        """Status of every registered device, live where we have heartbeats."""
+        now = datetime.utcnow()
+        with self.lock:
+            live = {k: dict(v) for k, v in self.state.items()}
+
+        rows = db.query(Device, DeviceStatus).outerjoin(DeviceStatus).all()
+        fleet = []
+        for device, stored in rows:
+            entry = live.get(device.id)
+            if entry is None and stored is not None:
+                entry = {
+                    "last_seen": stored.last_seen,
+                    "model_version": stored.model_version,
+                    "scan_rate": stored.scan_rate,
+                    "queue_depth": stored.queue_depth,
+                    "p95_ms": stored.p95_ms,
+                }
+            entry = entry or {}
+            last_seen = entry.get("last_seen")
+            fleet.append(
+                {
+                    "id": device.id,
+                    "name": device.name,
+                    "online": last_seen is not None
+                    and (now - last_seen).total_seconds() <= self.stale_after,
+                    "last_seen": last_seen,
+                    "model_version": entry.get("model_version"),
+                    "scan_rate": entry.get("scan_rate"),
+                    "queue_depth": entry.get("queue_depth"),
+                    "p95_ms": entry.get("p95_ms"),
+                }
+            )
+        metrics.FLEET_ONLINE.set(sum(d["online"] for d in fleet))
+        return fleet
+
+    # --- FLUSH ---
+    def flush(self):
+        with self.lock:
+            batch = {i: dict(self.state[i]) for i in self.dirty if i in self.state}
+            self.dirty.clear()
+            for entry in self.state.values():
+                entry["heartbeats"] = 0
+                entry["peak_queue_depth"] = entry.get("queue_depth") or 0
+        if not batch:
+            return 0
+
+        db = SessionLocal()
+        try:
+            existing = {
+                s.device_id: s
+                for s in db.query(DeviceStatus).filter(
+                    DeviceStatus.device_id.in_(batch)
+                )
+            }
+            known = {
+                d for (d,) in db.query(Device.id).filter(Device.id.in_(batch))
+            }
+            for device_id, entry in batch.items():
+                if device_id not in known:
+                    continue
+                row = existing.get(device_id)
+                if row is None:
+                    row = DeviceStatus(device_id=device_id, heartbeats=0)
+                    db.add(row)
+                row.last_seen = entry["last_seen"]
+                row.model_version = entry.get("model_version")
+                row.scan_rate = entry.get("scan_rate")
+                row.queue_depth = entry["peak_queue_depth"]
+                row.p95_ms = entry.get("p95_ms")
+                row.heartbeats += entry["heartbeats"]
+            with metrics.DB_COMMIT_SECONDS.time():
+                db.commit()
+        except Exception:
+            db.rollback()
+            # Retry with the next flush; counts since then are lost
+            with self.lock:
+                self.dirty.update(i for i in batch if i in self.state)
+            raise
+        finally:
+            db.close()
+        return len(batch)
+
+    def _run(self):
+        while True:
+            time.sleep(self.flush_interval)
+            try:
+                self.flush()
+            except Exception as e:
+                print("Fleet status flush failed:", e)
+
+    def start(self):
+        thread = Thread(target=self._run)
+        thread.daemon = True
+        thread.start()
+
+
+def heartbeat_device(registry: FleetRegistry):
+    """Dependency resolving the heartbeat's api-key header through the cache."""
+
+    def dependency(api_key: str = Header(...)):
+        return registry.authenticate(api_key)
+
+    return dependency
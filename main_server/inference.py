@@ -0,0 +1,127 @@
+import io
+import multiprocessing as mp
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from multiprocessing import shared_memory
+from threading import BoundedSemaphore, Lock
+
+import torch
+
+from main_server import metrics
+
+# Set in the parent before the first pool forks, so workers share its pages
+_classifier = None
+
+
+class InferenceUnavailable(Exception):
+    """Offloaded inference cannot be served now; the edge should classify."""
+
+
+def _init_worker(model_path=None, version_path=None):
+    global _classifier
+    # One intra-op thread per worker, parallelism comes from the pool
+    torch.set_num_threads(1)
+    if model_path is not None:
+        from classifier.classifier import ImageClassifier
+
+        _classifier = ImageClassifier(model_path, version_path, cache_size=0)
+
+
+def _classify_shared(name: str, size: int) -> int:
+    if _classifier is None or _classifier.model is None:
+        raise InferenceUnavailable("Model not loaded")
+    shm = shared_memory.SharedMemory(name=name)
+    try:
+        frame = io.BytesIO(bytes(shm.buf[:size]))
+    finally:
+        shm.close()
+    return _classifier.predict(_classifier.preprocess(frame)).label
+
+
+class InferencePool:
+    """Classifies uploaded frames in worker processes.
+
+    The first pool is forked before the server starts any other thread, so
+    workers share the already loaded model copy-on-write. Pools started
+    later, after a model reload or a worker crash, use forkserver and load
+    the model in each worker, as forking a process that is already serving
+    requests can deadlock the child.
+
+    Frames are handed over in shared memory blocks and only the block name
+    travels through the pool queue. At most max_pending frames may be queued
+    or running; a slot is only freed when its worker is done, even if the
+    request gave up waiting, so the limit holds under overload too.
+    """
+
+    def __init__(self, classifier, workers: int = 2, max_pending: int = 8):
+        self.classifier = classifier
+        self.workers = workers
+        self.slots = BoundedSemaphore(max_pending)
+        self.executor = None
+        self.lock = Lock()
+
+    def start(self):
+        global _classifier
+        _classifier = self.classifier
+        self.executor = ProcessPoolExecutor(
+            max_workers=self.workers,
+            mp_context=mp.get_context("fork"),
+            initializer=_init_worker,
+        )
+        # Fork all workers now rather than on the first offloaded scan
+        self.executor.submit(int).result()
+
+    def restart(self):
+        """Replace the workers, e.g. after the parent reloaded its model."""
+        with self.lock:
+            old = self.executor
+            self.executor = ProcessPoolExecutor(
+                max_workers=self.workers,
+                mp_context=mp.get_context("forkserver"),
+                initializer=_init_worker,
+                initargs=(self.classifier.model_path, self.classifier.version_path),
+            )
+        if old is not None:
+            old.shutdown(wait=False)
+
+    def classify(self, data: bytes, timeout: float = 10, wait: float = 0.5) -> int:
+        if self.classifier.model is None:
+            raise InferenceUnavailable("Model not loaded")
+        if not self.slots.acquire(timeout=wait):
+            raise InferenceUnavailable("Inference queue is full")
+
+        metrics.INFERENCE_QUEUE_DEPTH.inc()
+        shm = shared_memory.SharedMemory(create=True, size=len(data))
+
+        def release(_future=None):
+            shm.close()
+            shm.unlink()
+            metrics.INFERENCE_QUEUE_DEPTH.dec()
+            self.slots.release()
+
+        executor = self.executor
+        try:
+            shm.buf[: len(data)] = data
+            future = executor.submit(_classify_shared, shm.name, len(data))
+        except BrokenProcessPool:
+            release()
+            self._recover(executor)
+            raise InferenceUnavailable("Inference workers restarting")
+        except Exception:
+            release()
+            raise
+        # Runs when the worker finishes, also after we stopped waiting
+        future.add_done_callback(release)
+
+        try:
+            with metrics.INFERENCE_SECONDS.time():
+                return future.result(timeout=timeout)
+        except BrokenProcessPool:
+            self._recover(executor)
+            raise InferenceUnavailable("Inference worker died, restarting")
+
+    def _recover(self, broken):
+        # Several requests may notice the same broken pool, restart it once
+        if self.executor is broken:
+            print("Inference pool broken, restarting workers")
+            self.restart()
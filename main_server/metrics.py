@@ -0,0 +1,53 @@
+import time
+
+from prometheus_client import Counter, Gauge, Histogram
+from sqlalchemy import event
+
+DB_QUERY_SECONDS = Histogram(
+    "main_db_query_seconds",
+    "Time spent executing a single SQL statement",
+    buckets=(0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 1.0),
+)
+DB_COMMIT_SECONDS = Histogram(
+    "main_db_commit_seconds", "Time spent committing a session"
+)
+VALIDATE_SECONDS = Histogram(
+    "main_validate_seconds", "Total server-side time of a /validate call"
+)
+INFERENCE_SECONDS = Histogram(
+    "main_inference_seconds", "Time to classify an offloaded frame, including queueing"
+)
+
+VERDICTS = Counter(
+    "main_verdicts_total", "Scan verdicts by result and device", ["result", "device"]
+)
+MODEL_RELOADS = Counter("main_model_reloads_total", "Model reloads on main server")
+QUEUE_DEPTH = Gauge("main_queue_depth", "Validate requests currently in flight")
+HEARTBEATS = Counter("main_heartbeats_total", "Device heartbeats received")
+FLEET_ONLINE = Gauge("main_fleet_online", "Devices with a recent heartbeat")
+INFERENCE_QUEUE_DEPTH = Gauge(
+    "main_inference_queue_depth", "Offloaded frames queued or being classified"
+)
+ARCHIVE_QUEUE_DEPTH = Gauge(
+    "main_archive_queue_depth", "Scan images waiting to be written to the archive"
+)
+ARCHIVE_DROPPED = Counter(
+    "main_archive_dropped_total", "Scan images dropped because the archive was behind"
+)
+
+
+def instrument_engine(engine):
+    """Record statement execution time of every query run on engine."""
+
+    # The start time lives on the statement's execution context, so a failed
+    # statement leaves nothing behind on the pooled connection.
+    @event.listens_for(engine, "before_cursor_execute")
+    def _before(conn, cursor, statement, parameters, context, executemany):
+        if context is not None:
+            context._query_start = time.perf_counter()
+
+    @event.listens_for(engine, "after_cursor_execute")
+    def _after(conn, cursor, statement, parameters, context, executemany):
+        start = getattr(context, "_query_start", None)
+        if start is not None:
+            DB_QUERY_SECONDS.observe(time.perf_counter() - start)
@@ -1,4 +1,4 @@
-from sqlalchemy import Column, Integer, String, Float, ForeignKey, DateTime
+from sqlalchemy import Column, Integer, String, Float, ForeignKey, DateTime, Index
 from sqlalchemy.orm import relationship
 from datetime import datetime
 from main_server.db import Base
@@ -27,7 +27,32 @@ class Incident(Base):
     device_id = Column(Integer, ForeignKey("devices.id"))
     weight = Column(Float())
     result = Column(String)
-    timestamp = Column(DateTime, default=datetime.utcnow)
+    timestamp = Column(DateTime, default=datetime.utcnow, index=True)
+    # Compact JSON of per-stage scan times in ms, e.g. {"capture":812,"infer":95}
+    timings = Column(String)
+    duration_ms = Column(Integer)
+    # sha256 of the archived scan image, if the edge uploaded one
+    image_hash = Column(String(64))
 
     product = relationship("Product", back_populates="incidents")
     device = relationship("Device", back_populates="incidents")
+
+    __table_args__ = (
+        Index("ix_incidents_device_duration", "device_id", "duration_ms"),
+        Index("ix_incidents_device_timestamp", "device_id", "timestamp"),
+    )
+
+
+class DeviceStatus(Base):
+    """Last flushed heartbeat aggregates of a device, one row per device."""
+
+    __tablename__ = "device_status"
+    device_id = Column(
+        Integer, ForeignKey("devices.id", ondelete="CASCADE"), primary_key=True
+    )
+    last_seen = Column(DateTime)
+    model_version = Column(String)
+    scan_rate = Column(Float())  # scans per minute
+    queue_depth = Column(Integer)  # peak since the previous flush
+    p95_ms = Column(Integer)
+    heartbeats = Column(Integer, default=0)
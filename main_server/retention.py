@@ -0,0 +1,227 @@
+import os
+import time
+from datetime import datetime, timedelta
+from threading import Lock, Thread
+
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.parquet as pq
+from sqlalchemy import select
+from sqlalchemy.orm import Session, joinedload
+
+from main_server.db import SessionLocal
+from main_server.models import Incident
+
+# Incidents are partitioned by month: the live table keeps the recent ones,
+# older months live in one zstd-compressed Parquet file each.
+# Held while a month moves from the table to its file; see export_rows.
+move_lock = Lock()
+SCHEMA = pa.schema(
+    [
+        ("id", pa.int64()),
+        ("timestamp", pa.timestamp("us")),
+        ("product_id", pa.int64()),
+        ("product", pa.string()),
+        ("predicted_label", pa.int64()),
+        ("device_id", pa.int64()),
+        ("device", pa.string()),
+        ("weight", pa.float64()),
+        ("result", pa.string()),
+        ("timings", pa.string()),
+        ("duration_ms", pa.int64()),
+        ("image_hash", pa.string()),
+    ]
+)
+
+
+def month_start(ts: datetime) -> datetime:
+    return ts.replace(day=1, hour=0, minute=0, second=0, microsecond=0)
+
+
+def next_month(ts: datetime) -> datetime:
+    return (ts.replace(day=1) + timedelta(days=32)).replace(day=1)
+
+
+def partition_path(archive_dir: str, month: datetime) -> str:
+    return os.path.join(archive_dir, f"incidents-{month:%Y-%m}.parquet")
+
+
+def to_row(i: Incident) -> dict:
+    return {
+        "id": i.id,
+        "timestamp": i.timestamp,
+        "product_id": i.product_id,
+        "product": i.product.name if i.product else None,
+        "predicted_label": i.predicted_label,
+        "device_id": i.device_id,
+        "device": i.device.name if i.device else None,
+        "weight": i.weight,
+        "result": i.result,
+        "timings": i.timings,
+        "duration_ms": i.duration_ms,
+        "image_hash": i.image_hash,
+    }
+
+
+def archive_month(
+    db: Session, archive_dir: str, month: datetime, batch_size: int = 1000
+) -> int:
+    """Move one month of incidents from the live table to its Parquet file.
+
+    Rows are streamed into the file batch_size at a time and then deleted in
+    id ranges of the same size with a commit per range, so neither the
+    export nor the delete holds the whole month in memory or one transaction.
+    """
+    end = next_month(month)
+    in_month = (Incident.timestamp >= month, Incident.timestamp < end)
+    result = db.execute(
+        select(Incident.id)
+        .where(*in_month)
+        .order_by(Incident.id)
+        .execution_options(yield_per=batch_size)
+    )
+    chunks = [pa.array(ids, type=pa.int64()) for ids in result.scalars().partitions()]
+    if not chunks:
+        return 0
+    last_id = chunks[-1][-1].as_py()
+
+    path = partition_path(archive_dir, month)
+    tmp = f"{path}.tmp"
+    moved = 0
+    with pq.ParquetWriter(tmp, SCHEMA, compression="zstd") as writer:
+        if os.path.exists(path):
+            # A previous run exported but did not delete; merge without duplicates
+            live_ids = pa.concat_arrays(chunks)
+            for batch in pq.ParquetFile(path).iter_batches(batch_size=batch_size):
+                keep = pc.invert(pc.is_in(batch.column("id"), value_set=live_ids))
+                writer.write_batch(batch.filter(keep))
+
+        query = (
+            db.query(Incident)
+            .options(joinedload(Incident.product), joinedload(Incident.device))
+            .filter(*in_month, Incident.id <= last_id)
+            .order_by(Incident.id)
+        )
+        rows = []
+        for incident in query.yield_per(batch_size):
+            rows.append(to_row(incident))
+            if len(rows) == batch_size:
+                writer.write_batch(pa.RecordBatch.from_pylist(rows, schema=SCHEMA))
+                moved += len(rows)
+                rows = []
+        if rows:
+            writer.write_batch(pa.RecordBatch.from_pylist(rows, schema=SCHEMA))
+            moved += len(rows)
+    os.replace(tmp, path)
+
+    for ids in chunks:
+        db.query(Incident).filter(
+            *in_month, Incident.id.between(ids[0].as_py(), ids[-1].as_py())
+        ).delete(synchronize_session=False)
+        db.commit()
+    return moved
+
+
+def archive_old_incidents(db: Session, archive_dir: str, retention_days: float) -> int:
+    """Archive every whole month that ended more than retention_days ago."""
+    os.makedirs(archive_dir, exist_ok=True)
+    cutoff = datetime.utcnow() - timedelta(days=retention_days)
+    oldest = db.query(Incident.timestamp).order_by(Incident.timestamp).first()
+    if oldest is None or oldest[0] is None:
+        return 0
+
+    moved = 0
+    month = month_start(oldest[0])
+    while next_month(month) <= cutoff:
+        with move_lock:
+            moved += archive_month(db, archive_dir, month)
+        month = next_month(month)
+    return moved
+
+
+def open_archived(archive_dir: str, start: datetime | None, end: datetime | None):
+    """Open the month files overlapping [start, end), oldest first."""
+    if not os.path.isdir(archive_dir):
+        return []
+    files = []
+    for name in sorted(os.listdir(archive_dir)):
+        if not (name.startswith("incidents-") and name.endswith(".parquet")):
+            continue
+        month = datetime.strptime(name[len("incidents-") : -len(".parquet")], "%Y-%m")
+        if (end is not None and month >= end) or (
+            start is not None and next_month(month) <= start
+        ):
+            continue
+        files.append(open(os.path.join(archive_dir, name), "rb"))
+    return files
+
+
+def iter_archived(files: list, start: datetime | None, end: datetime | None):
+    """Yield archived incident rows in [start, end), one month file at a time."""
+    for f in files:
+        for batch in pq.ParquetFile(f).iter_batches():
+            for row in batch.to_pylist():
+                ts = row["timestamp"]
+                if (start is None or ts >= start) and (end is None or ts < end):
+                    yield row
+
+
+def iter_live(db: Session, start: datetime | None, end: datetime | None):
+    """Yield live incident rows in [start, end) without loading them all."""
+    query = (
+        db.query(Incident)
+        .options(joinedload(Incident.product), joinedload(Incident.device))
+        .order_by(Incident.timestamp)
+    )
+    if start is not None:
+        query = query.filter(Incident.timestamp >= start)
+    if end is not None:
+        query = query.filter(Incident.timestamp < end)
+    for i in query.yield_per(1000):
+        yield to_row(i)
+
+
+def export_rows(
+    db: Session, archive_dir: str, start: datetime | None, end: datetime | None
+):
+    """Yield incident rows in [start, end), archived months first.
+
+    Both sources are read as of one cut-off: the month files are opened and
+    the live query started under move_lock. A month archived while the rows
+    are streamed is then not missed, because the open files keep their old
+    contents and the running query its snapshot of the table.
+    """
+    files = []
+    try:
+        with move_lock:
+            files = open_archived(archive_dir, start, end)
+            live = iter_live(db, start, end)
+            first = next(live, None)
+        yield from iter_archived(files, start, end)
+        if first is not None:
+            yield first
+            yield from live
+    finally:
+        for f in files:
+            f.close()
+
+
+def run_retention(archive_dir: str, retention_days: float, interval: float):
+    while True:
+        db = SessionLocal()
+        try:
+            moved = archive_old_incidents(db, archive_dir, retention_days)
+            if moved:
+                print(f"Archived {moved} incidents to {archive_dir}")
+        except Exception as e:
+            db.rollback()
+            print("Incident retention failed:", e)
+        finally:
+            db.close()
+        time.sleep(interval)
+
+
+def start_retention(archive_dir: str, retention_days: float, interval: float = 3600):
+    thread = Thread(target=run_retention, args=(archive_dir, retention_days, interval))
+    thread.daemon = True
+    thread.start()
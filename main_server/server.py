@@ -1,25 +1,32 @@
 # main_server/main.py
 from fastapi import FastAPI, UploadFile, File, Form, HTTPException, Depends, Request
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.responses import JSONResponse, FileResponse
+from fastapi.responses import JSONResponse, FileResponse, Response, StreamingResponse
 from sqlalchemy.orm import Session
 from uuid import uuid4
 import os
+import json
+import time
+from datetime import datetime, timezone
 from dotenv import load_dotenv
 import uvicorn
 import requests
+from prometheus_client import generate_latest, CONTENT_TYPE_LATEST
 
-from main_server.db import SessionLocal, engine, Base
-from main_server.models import Product, Incident, Device
+from main_server.db import SessionLocal, engine, Base, migrate
+from main_server.models import Product, Incident, Device, DeviceStatus
 from main_server.auth import get_current_device
+from main_server import metrics
+from main_server.archive import ImageArchive
+from main_server.inference import InferencePool, InferenceUnavailable
+from main_server import retention
+from main_server.fleet import FleetRegistry, heartbeat_device
 from classifier.classifier import ImageClassifier
 
 load_dotenv()
 
 SHARED_SECRET = os.getenv("SHARED_SECRET", "abc123")  # Store shared secret securely
 
-Base.metadata.create_all(bind=engine)
-
 app = FastAPI()
 
 origins = [
@@ -39,10 +46,27 @@ app.add_middleware(
 )
 
 
-UPLOAD_DIR = "uploads"
+UPLOAD_DIR = os.getenv("UPLOAD_DIR", "uploads")
+MAX_IMAGE_BYTES = int(os.getenv("MAX_IMAGE_BYTES", 5 * 1024**2))
 os.makedirs(UPLOAD_DIR, exist_ok=True)
 
-classifier = ImageClassifier()
+archive = ImageArchive(
+    UPLOAD_DIR,
+    max_bytes=int(os.getenv("ARCHIVE_MAX_BYTES", 1024**3)),
+    max_age_days=float(os.getenv("ARCHIVE_MAX_AGE_DAYS", 30)),
+)
+
+fleet = FleetRegistry(
+    flush_interval=float(os.getenv("FLEET_FLUSH_INTERVAL", 30)),
+    stale_after=float(os.getenv("FLEET_STALE_AFTER", 60)),
+)
+
+INCIDENT_ARCHIVE_DIR = os.getenv("INCIDENT_ARCHIVE_DIR", "archive")
+
+# Loaded at startup below, not on import: inference workers re-import this
+# module and must not load the model or start servers of their own
+classifier = None
+inference_pool = None
 
 
 def get_db():
@@ -53,6 +77,11 @@ def get_db():
         db.close()
 
 
+@app.get("/metrics")
+def get_metrics():
+    return Response(generate_latest(), media_type=CONTENT_TYPE_LATEST)
+
+
 @app.post("/register_device")
 def register_device(
     device_name: str = Form(...),
@@ -65,6 +94,7 @@ def register_device(
 
     device = db.query(Device).filter_by(name=device_name).first()
     if device:
+        fleet.forget(device.id)
         device.api_key = str(uuid4())
         device.address = address
         db.commit()
@@ -103,6 +133,9 @@ def unregister_device(
             status_code=404, detail="Device not found or invalid credentials"
         )
 
+    fleet.forget(device.id)
+    # SQLite does not enforce the cascade, so delete the status row here
+    db.query(DeviceStatus).filter_by(device_id=device.id).delete()
     db.delete(device)
     db.commit()
     return {"detail": "Device unregistered successfully"}
@@ -114,6 +147,33 @@ def get_devices(db: Session = Depends(get_db)):
     return [{"id": d.id, "name": d.name} for d in devices]
 
 
+@app.post("/heartbeat")
+def heartbeat(
+    model_version: str = Form(None),
+    scan_rate: float = Form(None),
+    queue_depth: int = Form(None),
+    p95_ms: int = Form(None),
+    device: tuple = Depends(heartbeat_device(fleet)),
+):
+    device_id, device_name = device
+    fleet.heartbeat(
+        device_id,
+        device_name,
+        {
+            "model_version": model_version,
+            "scan_rate": scan_rate,
+            "queue_depth": queue_depth,
+            "p95_ms": p95_ms,
+        },
+    )
+    return {"status": "ok"}
+
+
+@app.get("/fleet")
+def fleet_status(db: Session = Depends(get_db)):
+    return fleet.status(db)
+
+
 @app.post("/remove_device")
 def remove_device(
     device_id: int = Form(...),
@@ -127,6 +187,9 @@ def remove_device(
     if not device:
         raise HTTPException(status_code=404, detail="Device not found")
 
+    fleet.forget(device.id)
+    # SQLite does not enforce the cascade, so delete the status row here
+    db.query(DeviceStatus).filter_by(device_id=device.id).delete()
     db.delete(device)
     db.commit()
     return {"message": f"Device '{device.name}' removed."}
@@ -135,25 +198,69 @@ def remove_device(
 @app.post("/validate")
 def validate(
     product_id: int = Form(...),
-    pred_model_label: int = Form(),
+    pred_model_label: int = Form(None),
     weight: float = Form(...),
+    timings: str = Form(None),
+    image: UploadFile = File(None),
     db: Session = Depends(get_db),
     device: Device = Depends(get_current_device),
 ):
+    with metrics.QUEUE_DEPTH.track_inprogress(), metrics.VALIDATE_SECONDS.time():
+        return _validate(
+            product_id, pred_model_label, weight, timings, image, db, device
+        )
+
+
+def parse_timings(timings: str | None) -> dict:
+    """Parse the edge stage timeline, keeping only numeric ms entries."""
+    try:
+        raw = json.loads(timings) if timings else {}
+    except ValueError:
+        return {}
+    if not isinstance(raw, dict):
+        return {}
+    return {
+        str(k): round(v)
+        for k, v in raw.items()
+        if isinstance(v, (int, float)) and not isinstance(v, bool)
+    }
+
+
+def _validate(product_id, pred_model_label, weight, timings, image, db, device):
+    started = time.perf_counter()
     product = db.query(Product).filter_by(id=product_id).first()
     if not product:
         raise HTTPException(status_code=404, detail="Product not found")
 
-    # # Save image
-    # if image.filename is not None:
-    #     img_path = os.path.join(UPLOAD_DIR, image.filename)
-    # else:
-    #     HTTPException(status_code=400, detail="Image missing")
-    # with open(img_path, "wb") as buffer:
-    #     shutil.copyfileobj(image.file, buffer)
+    # Save image: spool and hash here, file it in the archive in the background
+    image_hash = image_data = None
+    if image is not None:
+        try:
+            image_hash, spooled = archive.spool(image.file, MAX_IMAGE_BYTES)
+        except ValueError as e:
+            raise HTTPException(status_code=413, detail=str(e))
+        if pred_model_label is None:
+            # Offloaded: the inference workers need the frame itself
+            with open(spooled, "rb") as f:
+                image_data = f.read()
+        archive.submit(image_hash, spooled)
+
+    # Classify, if the edge offloaded inference to us
+    timeline = parse_timings(timings)
+    if pred_model_label is None:
+        if image is None:
+            raise HTTPException(
+                status_code=400, detail="Either pred_model_label or image required"
+            )
+        offload_start = time.perf_counter()
+        try:
+            pred_model_label = inference_pool.classify(image_data)
+        except InferenceUnavailable as e:
+            raise HTTPException(status_code=503, detail=str(e))
+        except TimeoutError:
+            raise HTTPException(status_code=504, detail="Inference timed out")
+        timeline["offload"] = round((time.perf_counter() - offload_start) * 1000)
 
-    # # Classify
-    # pred_model_label = classify_image(img_path)
     pred_product = db.query(Product).filter_by(model_label=pred_model_label).first()
 
     if pred_product is not None:
@@ -170,17 +277,31 @@ def validate(
 
     print(f"Is valid: {is_valid}")
 
+    # HTTP round-trip is only known to the edge after we answer, so the stored
+    # timeline covers the edge stages up to inference plus our own validate.
+    timeline["validate"] = round((time.perf_counter() - started) * 1000)
+
     incident = Incident(
         product_id=product.id,
         predicted_label=pred_model_label,
         device_id=device.id,
         weight=weight,
         result="correct" if is_valid else "incorrect",
+        timings=json.dumps(timeline, separators=(",", ":")),
+        # "offload" is already part of "validate"
+        duration_ms=sum(v for k, v in timeline.items() if k != "offload"),
+        image_hash=image_hash,
     )
     db.add(incident)
-    db.commit()
+    with metrics.DB_COMMIT_SECONDS.time():
+        db.commit()
+    metrics.VERDICTS.labels(result=incident.result, device=device.name).inc()
 
-    return {"result": incident.result}
+    return {
+        "result": incident.result,
+        "predicted_label": pred_model_label,
+        "validate_ms": timeline["validate"],
+    }
 
 
 @app.get("/incidents/last")
@@ -190,6 +311,7 @@ def last_incidents(count: int = 10, db: Session = Depends(get_db)):
     )
     return [
         {
+            "id": i.id,
             "product": i.product.name,
             "label": i.product.model_label,
             "predicted label": i.predicted_label,
@@ -197,11 +319,115 @@ def last_incidents(count: int = 10, db: Session = Depends(get_db)):
             "result": i.result,
             "timestamp": i.timestamp,
             "device": i.device.name if i.device else None,
+            "duration_ms": i.duration_ms,
+            "image": i.image_hash,
         }
         for i in incidents
     ]
 
 
+def _incident_image(incident_id: int, db: Session) -> str:
+    incident = db.query(Incident).filter_by(id=incident_id).first()
+    if not incident or not incident.image_hash:
+        raise HTTPException(status_code=404, detail="Image not found")
+    return incident.image_hash
+
+
+@app.get("/incidents/{incident_id}/image")
+def incident_image(incident_id: int, db: Session = Depends(get_db)):
+    path = archive.path(_incident_image(incident_id, db))
+    if not os.path.exists(path):
+        raise HTTPException(status_code=404, detail="Image expired")
+    return FileResponse(path, media_type="image/jpeg")
+
+
+@app.get("/incidents/{incident_id}/thumbnail")
+def incident_thumbnail(incident_id: int, db: Session = Depends(get_db)):
+    path = archive.thumb_path(_incident_image(incident_id, db))
+    if not os.path.exists(path):
+        raise HTTPException(status_code=404, detail="Thumbnail not ready")
+    return FileResponse(path, media_type="image/jpeg")
+
+
+@app.get("/incidents/export")
+def export_incidents(start: datetime | None = None, end: datetime | None = None):
+    """Stream incidents in [start, end) as NDJSON, archived months first."""
+    # Incidents are stored as naive UTC
+    start, end = (
+        t.astimezone(timezone.utc).replace(tzinfo=None) if t and t.tzinfo else t
+        for t in (start, end)
+    )
+
+    def rows():
+        db = SessionLocal()
+        try:
+            for row in retention.export_rows(db, INCIDENT_ARCHIVE_DIR, start, end):
+                yield json.dumps(row, default=str) + "\n"
+        finally:
+            db.close()
+
+    return StreamingResponse(rows(), media_type="application/x-ndjson")
+
+
+@app.get("/incidents/slow")
+def slow_incidents(
+    device_id: int | None = None,
+    quantile: float = 0.95,
+    count: int = 10,
+    db: Session = Depends(get_db),
+):
+    """Slowest scans per device, above that device's duration quantile."""
+    if not 0 <= quantile < 1:
+        raise HTTPException(status_code=400, detail="Quantile must be in [0, 1)")
+
+    devices = db.query(Device)
+    if device_id is not None:
+        devices = devices.filter_by(id=device_id)
+
+    results = []
+    for d in devices.all():
+        timed = db.query(Incident).filter(
+            Incident.device_id == d.id, Incident.duration_ms.isnot(None)
+        )
+        total = timed.count()
+        if not total:
+            continue
+        # Walk the (device_id, duration_ms) index from the top to the cut-off
+        offset = int(total * (1 - quantile))
+        threshold = (
+            timed.with_entities(Incident.duration_ms)
+            .order_by(Incident.duration_ms.desc())
+            .offset(min(offset, total - 1))
+            .limit(1)
+            .scalar()
+        )
+        slow = (
+            timed.filter(Incident.duration_ms >= threshold)
+            .order_by(Incident.duration_ms.desc())
+            .limit(count)
+            .all()
+        )
+        results.append(
+            {
+                "device": d.name,
+                "scans": total,
+                "threshold_ms": threshold,
+                "incidents": [
+                    {
+                        "id": i.id,
+                        "product": i.product.name if i.product else None,
+                        "result": i.result,
+                        "timestamp": i.timestamp,
+                        "duration_ms": i.duration_ms,
+                        "timings": json.loads(i.timings),
+                    }
+                    for i in slow
+                ],
+            }
+        )
+    return results
+
+
 @app.post("/add_product")
 def add_product(
     name: str = Form(...),
@@ -238,6 +464,8 @@ def reset_devices(db: Session = Depends(get_db), shared_secret: str = Form(...))
     if shared_secret != SHARED_SECRET:
         raise HTTPException(status_code=403, detail="Invalid shared secret")
 
+    fleet.forget()
+    db.query(DeviceStatus).delete()
     deleted = db.query(Device).delete()
     db.commit()
     return {"message": f"Reset successful. {deleted} devices removed."}
@@ -262,6 +490,8 @@ def force_update_models(db: Session = Depends(get_db), shared_secret: str = Form
     results = []
     
     classifier.load_model()
+    inference_pool.restart()
+    metrics.MODEL_RELOADS.inc()
 
     for device in devices:
         try:
@@ -278,10 +508,33 @@ def force_update_models(db: Session = Depends(get_db), shared_secret: str = Form
     return {"results": results}
 
 
-uvicorn.run(
-    app=app,
-    host="0.0.0.0",
-    port=8000,
-    ssl_certfile=os.getenv("SSL_CERTFILE"),
-    ssl_keyfile=os.getenv("SSL_KEYFILE"),
-)
+if __name__ == "__main__":
+    Base.metadata.create_all(bind=engine)
+    migrate()
+    metrics.instrument_engine(engine)
+
+    classifier = ImageClassifier()
+
+    # Classifies frames from edges that offload inference to us. Forked
+    # before any other thread is started, so the workers inherit no locks.
+    inference_pool = InferencePool(
+        classifier,
+        workers=int(os.getenv("INFERENCE_WORKERS", 2)),
+        max_pending=int(os.getenv("INFERENCE_MAX_PENDING", 8)),
+    )
+    inference_pool.start()
+
+    archive.start()
+    fleet.start()
+    retention.start_retention(
+        INCIDENT_ARCHIVE_DIR,
+        retention_days=float(os.getenv("INCIDENT_RETENTION_DAYS", 90)),
+    )
+
+    uvicorn.run(
+        app=app,
+        host="0.0.0.0",
+        port=8000,
+        ssl_certfile=os.getenv("SSL_CERTFILE"),
+        ssl_keyfile=os.getenv("SSL_KEYFILE"),
+    )